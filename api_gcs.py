@@ -3,12 +3,20 @@
 # Importing modules.
 import requests as req
 import pandas as pd
+import numpy as np
 import io
+import base64
+import hashlib
 import logging
 import os
+import cProfile
+import pstats
+import random
+import tracemalloc
 from google.cloud import storage
-from typing import Union
+from typing import Union, Tuple
 from google.cloud.exceptions import GoogleCloudError
+from google.api_core.exceptions import PreconditionFailed
 
 
 """Input data used for data extraction, filtering, fetching and log creation."""
@@ -32,9 +40,26 @@ selected_columns = ["city", "location", "parameter.name", "latest.value", "lates
 # Filtering parameters.
 params = ["pm25", "pm10", "no2", "o3"]
 
+# Physical range bounds per parameter (µg/m³). Values outside the bounds (e.g. -999 sentinel) are removed.
+param_bounds = {"pm25": (0, 1000), "pm10": (0, 2000), "no2": (0, 2000), "o3": (0, 1000)}
+
+# Outlier detection - rolling z-score against station's recent readings.
+outlier_window = 24
+outlier_min_periods = 3
+outlier_z_score = 4.0
+
+# Minimal standard deviation per parameter (µg/m³), so flat history (e.g. whole numbers) does not disable detection.
+outlier_min_std = {"pm25": 1.0, "pm10": 1.0, "no2": 1.0, "o3": 1.0}
+
+# Readings older than this are flagged as stale.
+stale_after = pd.Timedelta(hours = 3)
+
 # Set up for logging automation/monitoring.
 logging.basicConfig(level = logging.INFO)
 
+# Number of entries kept in profiling reports (cumulative-time stats and allocation sites).
+profile_top_n = 25
+
 
 
 # === Functions ===
@@ -111,19 +136,261 @@ def normalize_data(json_data:dict, city: str, location: str) -> Union[pd.DataFra
     # Filtering parameters.
     filter_data = pick_data[pick_data["parameter.name"].isin(params)]
 
+    # Duplicated readings (pivot does not accept them) are kept as separate rows.
+    # They are resolved and flagged by validate_data.
+    duplicate = filter_data.groupby(["city", "location", "date", "time", "parameter.name"]).cumcount()
+
     # Pivoting over parameters.
-    final_data = filter_data.pivot(
-        index = ["city", "location", "date", "time"],
+    final_data = filter_data.assign(_duplicate = duplicate).pivot(
+        index = ["city", "location", "date", "time", "_duplicate"],
         columns = "parameter.name",
         values = "latest.value"
-    ).reset_index()
+    ).reset_index().drop(columns = "_duplicate")
 
     return final_data
 
 
 
-def save_to_file(df: pd.DataFrame, bucket_name: str, destination_name: str) -> Union[str, None]:
-    """Saving DataFrame as CSV to Google Cloud Storage bucket.
+def _parse_timestamp(df: pd.DataFrame) -> pd.Series:
+    """Parsing reading time (UTC) from "date" and "time" columns. Incorrect values are returned as NaT.
+
+    :param
+        -df: DF with "date" (%d:%m:%Y) and "time" (%H:%M:%S) columns.
+
+    :returns
+        -pd.Series: Reading time for every row.
+    """
+
+    # Date and time are parsed separately - few unique values are cached by pandas.
+    return (pd.to_datetime(df["date"], format = "%d:%m:%Y", errors = "coerce", utc = True)
+            + (pd.to_datetime(df["time"], format = "%H:%M:%S", errors = "coerce") - pd.Timestamp("1900-01-01")))
+
+
+
+def _rolling_mean_std(values: np.ndarray, station: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Computing mean and standard deviation of previous outlier_window readings of the same station.
+
+    Windows are computed at once from cumulative sums, without looping over stations.
+
+    :param
+        -values: Readings (rows x parameters) sorted by station and time. Missing readings are NaN.
+        -station: Station code of every row, sorted.
+
+    :returns
+        -tuple: Mean and standard deviation per row and parameter. NaN if fewer than outlier_min_periods readings.
+    """
+
+    # Window of every row - previous outlier_window rows, not crossing the first row of the station.
+    position = np.arange(len(station))
+    start = np.searchsorted(station, station, side = "left")
+    low = np.maximum(position - outlier_window, start)
+
+    # Cumulative sums with leading zero row - window sum is a difference of two cumulative sums.
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    zero = np.zeros((1, values.shape[1]))
+    count_sum = np.vstack([zero, np.cumsum(present, axis = 0)])
+    value_sum = np.vstack([zero, np.cumsum(filled, axis = 0)])
+    square_sum = np.vstack([zero, np.cumsum(filled ** 2, axis = 0)])
+
+    count = count_sum[position] - count_sum[low]
+    total = value_sum[position] - value_sum[low]
+    squares = square_sum[position] - square_sum[low]
+
+    # Sample standard deviation (ddof = 1). Negative variance comes from rounding only.
+    enough = count >= outlier_min_periods
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        mean = np.where(enough, total / count, np.nan)
+        variance = np.where(enough, (squares - total * mean) / (count - 1), np.nan)
+
+    return mean, np.sqrt(np.clip(variance, 0, None))
+
+
+
+def load_history(bucket_name: str, destination_name: str) -> Union[pd.DataFrame, None]:
+    """Loading previous readings from Google Cloud Storage bucket for outliers detection.
+
+    :param
+        -bucket_name: Name of a bucket for saving on GCS.
+        -destination_name: Name of the output file. History is read from "<name>.history.csv".
+
+    :returns
+        -pd.DataFrame: DF of previous readings.
+        -None: No history saved yet or unsuccessful loading.
+    """
+
+    history_name = f"{os.path.splitext(destination_name)[0]}.history.csv"
+
+    try:
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.get_blob(history_name)
+
+        if blob is None:
+            logging.info(f"No history in gs://{bucket_name}/{history_name} - outliers are not detected in this run.")
+            return None
+
+        return pd.read_csv(io.StringIO(blob.download_as_text()),
+                           dtype = {"city": str, "location": str, "date": str, "time": str})
+
+    except (Exception, IOError, GoogleCloudError) as err:
+        logging.warning(f"Error during loading history: {err}")
+        return None
+
+
+
+def save_history(df: pd.DataFrame, history: Union[pd.DataFrame, None], bucket_name: str,
+                 destination_name: str) -> Union[str, None]:
+    """Saving recent readings of every station to Google Cloud Storage bucket as a history for the next runs.
+
+    :param
+        -df: DF of a validated data from validate_data function. Values flagged as outliers are not saved.
+        -history: DF of previous readings from load_history function.
+        -bucket_name: Name of a bucket for saving on GCS.
+        -destination_name: Name of the output file. History is saved as "<name>.history.csv".
+
+    :returns
+        str: Path of the saved history.
+        None: Unsuccessful saving.
+    """
+
+    keys = ["city", "location", "date", "time"]
+    columns = keys + [col for col in params if col in df.columns or (history is not None and col in history.columns)]
+
+    # Appending current readings and keeping last outlier_window readings per station.
+    readings = df.reindex(columns = columns)
+
+    # Removing outlier values, so they do not become a part of the baseline for the next runs.
+    if "quality_flags" in df.columns:
+        for col in columns[len(keys):]:
+            if col in df.columns:
+                readings[col] = readings[col].mask(df["quality_flags"].str.contains(f"{col}:outlier", regex = False))
+
+    if history is not None and not history.empty:
+        readings = pd.concat([history.reindex(columns = columns), readings], ignore_index = True)
+
+    readings = readings.drop_duplicates(keys, keep = "last")
+    readings = readings.assign(_timestamp = _parse_timestamp(readings))
+    readings = readings.dropna(subset = ["_timestamp"]).sort_values(["city", "location", "_timestamp"], kind = "stable")
+    readings = readings.groupby(["city", "location"], sort = False).tail(outlier_window).drop(columns = "_timestamp")
+
+    history_name = f"{os.path.splitext(destination_name)[0]}.history.csv"
+
+    try:
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.blob(history_name)
+        blob.upload_from_string(readings.to_csv(index = False), content_type = "text/csv")
+        return f"gs://{bucket_name}/{history_name}"
+
+    except (Exception, IOError, GoogleCloudError) as err:
+        logging.warning(f"Error during saving history: {err}")
+        return None
+
+
+
+def validate_data(df: pd.DataFrame, history: Union[pd.DataFrame, None] = None,
+                  now: Union[pd.Timestamp, None] = None) -> pd.DataFrame:
+    """Validating normalized data. Bad readings are annotated in "quality_flags" column instead of failing the run.
+
+    :param
+        -df: DF of a concatenated data from normalize_data function.
+        -history: DF of previous readings from load_history function. Used for outliers detection only.
+        -now: Reference time (UTC) for stale readings detection. Current time is used if not provided.
+
+    :returns
+        -pd.DataFrame: DF without duplicates, with out-of-range values removed and "quality_flags" column added.
+                       Duplicated rows are merged per parameter (highest in-range value of each parameter).
+                       Flags are separated by ";" - "<parameter>:range" (out-of-range reading removed),
+                       "<parameter>:outlier" and "stale".
+    """
+
+    keys = ["city", "location", "date", "time"]
+    param_cols = [col for col in params if col in df.columns]
+
+    df = df.copy()
+
+    # Boolean mask per flag. Flags text is built at the end, only for flagged rows.
+    checks = {}
+
+    # Range bounds. Removing the values so they are neither saved nor used as a history for outliers.
+    # Applied before resolving duplicates, so an out-of-range duplicate does not replace a valid reading.
+    for col in param_cols:
+        low, high = param_bounds[col]
+        out_of_range = df[col].notna() & ~df[col].between(low, high)
+        checks[f"{col}:range"] = out_of_range
+        df[col] = df[col].mask(out_of_range)
+
+    # Resolving duplicated rows (same station and time) - keeping the highest in-range value per parameter.
+    # Each parameter is resolved separately, so the merged row can combine values from different source rows.
+    # Range flags of any duplicate are kept on the resolved row. Rows with missing date or time are kept (dropna).
+    if df.duplicated(keys).any():
+        df = df.assign(**checks).groupby(keys, as_index = False, sort = False, dropna = False).max()
+        checks = {name: df.pop(name) for name in list(checks)}
+
+    df = df.reset_index(drop = True)
+    checks = {name: check.reset_index(drop = True) for name, check in checks.items()}
+
+    # Reading time.
+    timestamp = _parse_timestamp(df)
+
+    # Rolling z-score against previous readings of the same station (history and current batch).
+    if param_cols:
+        readings = df[keys + param_cols].assign(_timestamp = timestamp)
+        past_count = 0
+
+        if history is not None and not history.empty:
+            # History of stations from current batch only. Skipping readings repeated in current batch,
+            # so a reading is not compared with itself.
+            past = history.reindex(columns = keys + param_cols)
+            same_station = pd.MultiIndex.from_frame(past[["city", "location"]]).isin(
+                pd.MultiIndex.from_frame(df[["city", "location"]]))
+            repeated = pd.MultiIndex.from_frame(past[keys]).isin(pd.MultiIndex.from_frame(df[keys]))
+            past = past[same_station & ~repeated]
+            past_count = len(past)
+            readings = pd.concat([past.assign(_timestamp = _parse_timestamp(past)), readings], ignore_index = True)
+
+        station = readings.groupby(["city", "location"], sort = False, dropna = False).ngroup()
+        readings = readings.assign(_station = station).sort_values(["_station", "_timestamp"], kind = "stable")
+
+        # Computing stats in sorted order and putting them back to original rows (history rows first).
+        order = readings.index.to_numpy()
+        sorted_mean, sorted_std = _rolling_mean_std(readings[param_cols].to_numpy(dtype = float),
+                                                    readings["_station"].to_numpy())
+        mean = np.empty_like(sorted_mean)
+        std = np.empty_like(sorted_std)
+        mean[order] = sorted_mean
+        std[order] = sorted_std
+
+        # Taking the stats of current batch rows only.
+        mean = pd.DataFrame(mean[past_count:], index = df.index, columns = param_cols)
+        std = pd.DataFrame(std[past_count:], index = df.index, columns = param_cols)
+        std = std.clip(lower = pd.Series(outlier_min_std)[param_cols], axis = 1)
+        z_score = (df[param_cols] - mean) / std
+
+        for col in param_cols:
+            checks[f"{col}:outlier"] = z_score[col].abs() > outlier_z_score
+
+    # Stale readings. Readings without correct time are treated as stale.
+    now = pd.Timestamp.now(tz = "UTC") if now is None else now
+    checks["stale"] = timestamp.isna() | (timestamp < now - stale_after)
+
+    # Annotating flagged rows.
+    checks = pd.DataFrame(checks)
+    flagged = checks.any(axis = 1)
+
+    df["quality_flags"] = ""
+    if flagged.any():
+        flagged_checks = checks[flagged]
+        df.loc[flagged, "quality_flags"] = flagged_checks.dot(flagged_checks.columns + ";").str.rstrip(";")
+        logging.warning(f"Validation flagged {int(flagged.sum())} of {len(df)} rows.")
+
+    return df
+
+
+
+def save_to_file(df: pd.DataFrame, bucket_name: str, destination_name: str) -> Union[Tuple[str, bool], None]:
+    """Saving DataFrame as CSV to Google Cloud Storage bucket. Upload is skipped when the file did not change.
 
     :param
         -df: DF of a normalized data from normalize_data function.
@@ -131,7 +398,7 @@ def save_to_file(df: pd.DataFrame, bucket_name: str, destination_name: str) -> U
         -destination_name: Name of a destination for saving on GCS.
 
     :returns
-        str: Path after successful GCS client initiation.
+        tuple: Path on GCS and True if the file was uploaded or False if the upload was skipped (file unchanged).
         None: Unsuccessful converting, initiation or file saving on GCS.
     """
 
@@ -145,13 +412,33 @@ def save_to_file(df: pd.DataFrame, bucket_name: str, destination_name: str) -> U
         logging.warning(f"Error during converting a file: {err}")
         return None
 
+    # Computing MD5 of the payload in the same (base64) format as GCS object metadata.
+    payload = csv_buffer.getvalue()
+    md5_hash = base64.b64encode(hashlib.md5(payload.encode("utf-8")).digest()).decode("ascii")
+    gcs_dest = f"gs://{bucket_name}/{destination_name}"
+
     #Initiating GCS client.
     try:
         storage_client = storage.Client()
         bucket = storage_client.bucket(bucket_name)
+
+        # Comparing with the existing object. Skipping the upload if the content is identical.
+        existing_blob = bucket.get_blob(destination_name)
+        if existing_blob is not None and existing_blob.md5_hash == md5_hash:
+            logging.info(f"{gcs_dest} is unchanged - upload skipped.")
+            return gcs_dest, False
+
+        # Generation precondition - upload fails if the object was changed (or created) by another writer meanwhile.
+        generation = existing_blob.generation if existing_blob is not None else 0
+
         blob = bucket.blob(destination_name)
-        blob.upload_from_string(csv_buffer.getvalue(), content_type = "text/csv")
-        return f"gs://{bucket_name}/{destination_name}"
+        blob.md5_hash = md5_hash
+        blob.upload_from_string(payload, content_type = "text/csv", if_generation_match = generation)
+        return gcs_dest, True
+
+    except PreconditionFailed as err:
+        logging.warning(f"{gcs_dest} was modified by another writer - upload aborted: {err}")
+        return None
 
     except (Exception, IOError, GoogleCloudError) as err:
         logging.warning(f"Error during client initiation: {err}")
@@ -159,33 +446,216 @@ def save_to_file(df: pd.DataFrame, bucket_name: str, destination_name: str) -> U
 
 
 
+def profiling_enabled(request) -> bool:
+    """Deciding whether current run should be profiled.
+
+    :param
+        -request: Condition used by Google Cloud Storage. "profile" query argument forces profiling on or off.
+
+    :returns
+        -bool: True if the run should be profiled, False otherwise.
+    """
+
+    # Request parameter takes precedence over sampling.
+    args = getattr(request, "args", None)
+    flag = args.get("profile") if args is not None else None
+
+    if flag is not None:
+        return str(flag).lower() in ("1", "true", "yes")
+
+    # Sampling a fraction of runs. PROFILE_SAMPLE_RATE=1 profiles every run, 0 (default) disables profiling.
+    try:
+        sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+
+    except ValueError:
+        logging.warning("PROFILE_SAMPLE_RATE is not a number - profiling disabled.")
+        return False
+
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+
+def profile_call(profile: Union[dict, None], name: str, func, *args):
+    """Calling function with cProfile and tracemalloc when profiling is enabled.
+
+    :param
+        -profile(dict): Collected profiling data per function name. None when profiling is disabled.
+                        tracemalloc has to be tracing when profile is provided.
+        -name(str): Name under which the stats are collected.
+        -func: Function to call.
+        -args: Arguments passed to the function.
+
+    :returns
+        -Result of the called function.
+    """
+
+    # No profiling - calling the function directly.
+    if profile is None:
+        return func(*args)
+
+    stage = profile.setdefault(name, {"profiler": cProfile.Profile(), "allocations": {}, "peak": 0})
+
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    stage["profiler"].enable()
+
+    try:
+        return func(*args)
+
+    finally:
+        stage["profiler"].disable()
+        after = tracemalloc.take_snapshot()
+        stage["peak"] = max(stage["peak"], tracemalloc.get_traced_memory()[1])
+
+        # Summing allocated memory per source line over all calls.
+        for stat in after.compare_to(before, "lineno"):
+            site = str(stat.traceback)
+            stage["allocations"][site] = stage["allocations"].get(site, 0) + stat.size_diff
+
+
+
+def format_profile(profile: dict) -> str:
+    """Building text report from collected profiling data.
+
+    :param
+        -profile(dict): Collected profiling data from profile_call function.
+
+    :returns
+        -str: Report with cumulative-time stats and top allocation sites per function.
+    """
+
+    report = io.StringIO()
+
+    for name, stage in profile.items():
+        report.write(f"=== {name} ===\n")
+        report.write(f"Peak traced memory: {stage['peak'] / 1024:.1f} KiB\n\n")
+
+        # Top allocation sites.
+        report.write("Top allocation sites:\n")
+        top_sites = sorted(stage["allocations"].items(), key = lambda item: item[1], reverse = True)[:profile_top_n]
+        for site, size in top_sites:
+            report.write(f"{size / 1024:>10.1f} KiB  {site}\n")
+
+        # Cumulative-time stats. Empty profiler (function raised before any call) has no stats to print.
+        report.write("\nCumulative-time stats:\n")
+        try:
+            pstats.Stats(stage["profiler"], stream = report).sort_stats("cumulative").print_stats(profile_top_n)
+
+        except TypeError:
+            report.write("No stats collected.\n")
+
+        report.write("\n")
+
+    return report.getvalue()
+
+
+
+def save_profile(profile: dict, bucket_name: Union[str, None], destination_name: str) -> Union[str, None]:
+    """Saving profiling report next to the output - to local directory or Google Cloud Storage bucket.
+
+    :param
+        -profile(dict): Collected profiling data from profile_call function.
+        -bucket_name: Name of a bucket for saving on GCS. Used when PROFILE_OUTPUT_DIR is not set.
+        -destination_name: Name of the output file. Report is saved as "<name>.<UTC time>.profile.txt".
+
+    :returns
+        str: Path of the saved report.
+        None: Unsuccessful saving or no destination available.
+    """
+
+    report = format_profile(profile)
+    # UTC time in the name, so reports of sampled runs do not overwrite each other.
+    run_time = pd.Timestamp.now(tz = "UTC").strftime("%Y%m%dT%H%M%S")
+    report_name = f"{os.path.splitext(destination_name)[0]}.{run_time}.profile.txt"
+
+    # Local directory takes precedence over the bucket.
+    output_dir = os.environ.get("PROFILE_OUTPUT_DIR")
+
+    try:
+        if output_dir:
+            report_path = os.path.join(output_dir, report_name)
+            with open(report_path, "w", encoding = "utf-8") as file:
+                file.write(report)
+            return report_path
+
+        if not bucket_name:
+            logging.warning("No destination for profiling report - set PROFILE_OUTPUT_DIR or GCS_BUCKET_NAME.")
+            return None
+
+        storage_client = storage.Client()
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.blob(report_name)
+        blob.upload_from_string(report, content_type = "text/plain")
+        return f"gs://{bucket_name}/{report_name}"
+
+    except (Exception, IOError, GoogleCloudError) as err:
+        logging.warning(f"Error during saving profiling report: {err}")
+        return None
+
+
+
 def run(request) -> str:
     """Main function for orchestrating all script.
 
     :param
-        -request: Condition used by Google Cloud Storage.
+        -request: Condition used by Google Cloud Storage. Optional "profile" argument enables profiling.
 
     :returns
         -str: Information whether data was or was not correctly collected and saved.
 
     """
 
-    # Creating empty DataFrame for data storing.
-    data = []
-
     # Checking if API key was set.
     if not api_key:
         logging.error("OPENAQ_API_KEY environment variable not set. Please set it before running the script.")
         raise EnvironmentError("API Key not set. Please set it before running the script.")
 
+    # Profiling data collected during the run. None when profiling is disabled.
+    profile = {} if profiling_enabled(request) else None
+
+    # Tracing memory allocations only when profiling. Already running tracemalloc is left untouched.
+    start_tracing = profile is not None and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+
+    destination_name = "results.csv"
+
+    try:
+        return _run_pipeline(profile, destination_name)
+
+    finally:
+        if start_tracing:
+            tracemalloc.stop()
+
+        if profile is not None:
+            report_path = save_profile(profile, os.environ.get("GCS_BUCKET_NAME"), destination_name)
+            if report_path is not None:
+                logging.info(f"Profiling report saved to {report_path}")
+
+
+
+def _run_pipeline(profile: Union[dict, None], destination_name: str) -> str:
+    """Fetching, processing and saving the data for all locations.
+
+    :param
+        -profile(dict): Collected profiling data. None when profiling is disabled.
+        -destination_name(str): Name of a destination for saving on GCS.
+
+    :returns
+        -str: Information whether data was or was not correctly collected and saved.
+    """
+
+    # Creating empty DataFrame for data storing.
+    data = []
+
     # Fetching the data and appending to the list.
     for url, (city, location) in locations.items():
-        json_data = fetch_data(url, header)
+        json_data = profile_call(profile, "fetch_data", fetch_data, url, header)
 
         if json_data is None:
             continue
 
-        df = normalize_data(json_data,city, location)
+        df = profile_call(profile, "normalize_data", normalize_data, json_data, city, location)
         if df is not None:
             data.append(df)
 
@@ -207,12 +677,22 @@ def run(request) -> str:
         logging.warning("GCS_BUCKET_NAME environment variable not set. Cannot save to GCS.")
         return "GCS Bucket Name not set. Failed to upload the file to GCS."
 
-    destination_name = "results.csv"
+    # Validating the data against previous readings.
+    history = load_history(bucket_name, destination_name)
+    concat_data = profile_call(profile, "validate_data", validate_data, concat_data, history)
 
     # Saving the file to GCS.
-    gcs_dest = save_to_file(concat_data, bucket_name, destination_name)
+    saved = profile_call(profile, "save_to_file", save_to_file, concat_data, bucket_name, destination_name)
 
-    if gcs_dest is None:
+    if saved is None:
         return "Failed to upload the file to GCS."
 
+    gcs_dest, uploaded = saved
+
+    if not uploaded:
+        return f"File unchanged - upload to {gcs_dest} skipped"
+
+    # Updating the history. Unchanged file means no new readings, so it is updated only after upload.
+    save_history(concat_data, history, bucket_name, destination_name)
+
     return f"File uploaded to {gcs_dest}"
\ No newline at end of file
@@ -3,11 +3,19 @@
 # Importing modules.
 import pytest
 import os
+import base64
+import re
+import io
+import hashlib
 import requests.exceptions
 import pandas as pd
 import openaq_data_pipeline.api_gcs as api_gcs
-from openaq_data_pipeline.api_gcs import fetch_data, normalize_data, save_to_file, run
+from openaq_data_pipeline.api_gcs import fetch_data, normalize_data, validate_data, save_to_file, run
+from openaq_data_pipeline.api_gcs import load_history, save_history
+from openaq_data_pipeline.api_gcs import profiling_enabled, profile_call, save_profile
 from google.cloud.exceptions import GoogleCloudError
+from google.api_core.exceptions import PreconditionFailed
+import tracemalloc
 from unittest.mock import patch, MagicMock, ANY
 
 
@@ -106,6 +114,10 @@ def test_fetch_data_empty(mock_log_warning, mock_get):
 
 # === Testing normalize_data ===
 
+# Reference time for validation tests.
+validation_now = pd.Timestamp("2025-07-15T13:00:00Z")
+
+
 # Correct DataFrame.
 def test_normalize_data_success():
     json_data = {
@@ -239,6 +251,362 @@ def test_normalize_data_pivot():
     assert df["no2"].iloc[0] == 8
 
 
+# Duplicated readings do not break pivoting.
+def test_normalize_data_duplicates():
+    json_data = {
+        "results" : [
+            {
+                "parameter.name" : "pm25",
+                "latest.value": 13,
+                "latest.datetime.utc": "2025-07-15T12:00:00Z"
+            },
+            {
+                "parameter.name": "pm25",
+                "latest.value": 21,
+                "latest.datetime.utc": "2025-07-15T12:00:00Z"
+            },
+            {
+                "parameter.name": "pm25",
+                "latest.value": None,
+                "latest.datetime.utc": "2025-07-15T12:00:00Z"
+            }
+        ]
+    }
+
+    df = normalize_data(json_data, "city", "location")
+
+    assert len(df) == 3
+    assert df["pm25"].iloc[:2].tolist() == [13, 21]
+    assert pd.isna(df["pm25"].iloc[2])
+
+    result = validate_data(df, now = validation_now)
+
+    assert len(result) == 1
+    assert result["pm25"].iloc[0] == 21
+
+
+
+# Out of range duplicate is flagged by validation and does not replace valid reading.
+def test_normalize_data_duplicates_out_of_range():
+    json_data = {
+        "results" : [
+            {
+                "parameter.name" : "pm25",
+                "latest.value": 25,
+                "latest.datetime.utc": "2025-07-15T12:00:00Z"
+            },
+            {
+                "parameter.name": "pm25",
+                "latest.value": 99999,
+                "latest.datetime.utc": "2025-07-15T12:00:00Z"
+            }
+        ]
+    }
+
+    df = normalize_data(json_data, "city", "location")
+
+    assert df["pm25"].tolist() == [25, 99999]
+
+    result = validate_data(df, now = validation_now)
+
+    assert len(result) == 1
+    assert result["pm25"].iloc[0] == 25
+    assert result["quality_flags"].iloc[0] == "pm25:range"
+
+
+
+# === Testing validate_data ===
+
+# Correct data - no flags.
+def test_validate_data_success():
+    df = pd.DataFrame({"city" : ["cityA"],
+                       "location" : ["locA"],
+                       "date" : ["15:07:2025"],
+                       "time" : ["12:00:00"],
+                       "pm25" : [7.0],
+                       "no2" : [12.0]
+                       })
+
+    result = validate_data(df, now = validation_now)
+
+    assert result["quality_flags"].iloc[0] == ""
+    assert result["pm25"].iloc[0] == 7.0
+    assert "quality_flags" not in df.columns
+
+
+# Out of range and sentinel values are removed and flagged.
+def test_validate_data_range():
+    df = pd.DataFrame({"city" : ["cityA", "cityB"],
+                       "location" : ["locA", "locB"],
+                       "date" : ["15:07:2025", "15:07:2025"],
+                       "time" : ["12:00:00", "12:00:00"],
+                       "pm25" : [-999.0, 7.0],
+                       "no2" : [-3.0, 5000.0]
+                       })
+
+    result = validate_data(df, now = validation_now)
+
+    assert result["quality_flags"].tolist() == ["pm25:range;no2:range", "no2:range"]
+    assert pd.isna(result["pm25"].iloc[0])
+    assert result["pm25"].iloc[1] == 7.0
+    assert result["no2"].isna().all()
+
+
+# Outlier against station's history from previous runs.
+def test_validate_data_outlier():
+    df = pd.DataFrame({"city" : ["cityA", "cityB"],
+                       "location" : ["locA", "locB"],
+                       "date" : ["15:07:2025", "15:07:2025"],
+                       "time" : ["12:00:00", "12:00:00"],
+                       "pm25" : [300.0, 10.0]
+                       })
+
+    history = pd.DataFrame({"city" : ["cityA"] * 4 + ["cityB"] * 4,
+                            "location" : ["locA"] * 4 + ["locB"] * 4,
+                            "date" : ["15:07:2025"] * 8,
+                            "time" : ["08:00:00", "09:00:00", "10:00:00", "11:00:00"] * 2,
+                            "pm25" : [10.0, 11.0, 9.0, 12.0, 10.0, 11.0, 9.0, 12.0]
+                            })
+
+    result = validate_data(df, history, now = validation_now)
+
+    assert result["quality_flags"].tolist() == ["pm25:outlier", ""]
+    assert len(result) == 2
+
+
+
+# Flat history - outlier detected with minimal standard deviation.
+def test_validate_data_outlier_flat_history():
+    df = pd.DataFrame({"city" : ["cityA", "cityA"],
+                       "location" : ["locA", "locA"],
+                       "date" : ["15:07:2025", "15:07:2025"],
+                       "time" : ["12:00:00", "12:30:00"],
+                       "pm25" : [900.0, 10.0]
+                       })
+
+    history = pd.DataFrame({"city" : ["cityA"] * 4,
+                            "location" : ["locA"] * 4,
+                            "date" : ["15:07:2025"] * 4,
+                            "time" : ["08:00:00", "09:00:00", "10:00:00", "11:00:00"],
+                            "pm25" : [10.0, 10.0, 10.0, 10.0]
+                            })
+
+    result = validate_data(df, history, now = validation_now)
+
+    assert result["quality_flags"].tolist() == ["pm25:outlier", ""]
+
+
+# Current readings repeated in history are not compared with themselves.
+def test_validate_data_outlier_repeated_reading():
+    df = pd.DataFrame({"city" : ["cityA"],
+                       "location" : ["locA"],
+                       "date" : ["15:07:2025"],
+                       "time" : ["12:00:00"],
+                       "pm25" : [300.0]
+                       })
+
+    history = pd.DataFrame({"city" : ["cityA"] * 4,
+                            "location" : ["locA"] * 4,
+                            "date" : ["15:07:2025"] * 4,
+                            "time" : ["09:00:00", "10:00:00", "11:00:00", "12:00:00"],
+                            "pm25" : [10.0, 11.0, 9.0, 300.0]
+                            })
+
+    result = validate_data(df, history, now = validation_now)
+
+    assert result["quality_flags"].iloc[0] == "pm25:outlier"
+
+
+# No history - outliers are not detected.
+def test_validate_data_outlier_no_history():
+    df = pd.DataFrame({"city" : ["cityA", "cityB", "cityC"],
+                       "location" : ["locA", "locB", "locC"],
+                       "date" : ["15:07:2025"] * 3,
+                       "time" : ["12:00:00"] * 3,
+                       "pm25" : [500.0, 10.0, 10.0]
+                       })
+
+    result = validate_data(df, now = validation_now)
+
+    assert (result["quality_flags"] == "").all()
+
+
+# Stale and incorrect reading times.
+def test_validate_data_stale():
+    df = pd.DataFrame({"city" : ["cityA", "cityB"],
+                       "location" : ["locA", "locB"],
+                       "date" : ["14:07:2025", "not a date"],
+                       "time" : ["12:00:00", "12:00:00"],
+                       "pm25" : [7.0, 8.0]
+                       })
+
+    result = validate_data(df, now = validation_now)
+
+    assert result["quality_flags"].tolist() == ["stale", "stale"]
+
+
+# Duplicated rows are merged - highest value kept.
+def test_validate_data_duplicates():
+    df = pd.DataFrame({"city" : ["cityA", "cityA"],
+                       "location" : ["locA", "locA"],
+                       "date" : ["15:07:2025", "15:07:2025"],
+                       "time" : ["12:00:00", "12:00:00"],
+                       "pm25" : [7.0, None],
+                       "no2" : [3.0, 4.0]
+                       })
+
+    result = validate_data(df, now = validation_now)
+
+    assert len(result) == 1
+    assert result["pm25"].iloc[0] == 7.0
+    assert result["no2"].iloc[0] == 4.0
+
+
+# Out of range duplicate does not replace valid reading.
+def test_validate_data_duplicates_out_of_range():
+    df = pd.DataFrame({"city" : ["cityA", "cityA"],
+                       "location" : ["locA", "locA"],
+                       "date" : ["15:07:2025", "15:07:2025"],
+                       "time" : ["12:00:00", "12:00:00"],
+                       "pm25" : [25.0, 99999.0]
+                       })
+
+    result = validate_data(df, now = validation_now)
+
+    assert len(result) == 1
+    assert result["pm25"].iloc[0] == 25.0
+    assert result["quality_flags"].iloc[0] == "pm25:range"
+
+
+# Rows with missing time are kept and flagged when duplicates are resolved.
+def test_validate_data_duplicates_missing_time():
+    df = pd.DataFrame({"city" : ["cityA", "cityA", "cityB"],
+                       "location" : ["locA", "locA", "locB"],
+                       "date" : ["15:07:2025", "15:07:2025", None],
+                       "time" : ["12:00:00", "12:00:00", None],
+                       "pm25" : [7.0, 8.0, 9.0]
+                       })
+
+    result = validate_data(df, now = validation_now)
+
+    assert len(result) == 2
+    assert result["pm25"].tolist() == [8.0, 9.0]
+    assert result["quality_flags"].tolist() == ["", "stale"]
+
+
+
+# === Testing history ===
+
+# History loaded from GCS bucket.
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_load_history_success(mock_client):
+    mock_blob = MagicMock()
+    mock_blob.download_as_text.return_value = "city,location,date,time,pm25\ncityA,locA,15:07:2025,12:00:00,7\n"
+
+    mock_bucket = MagicMock()
+    mock_bucket.get_blob.return_value = mock_blob
+    mock_client.return_value.bucket.return_value = mock_bucket
+
+    history = load_history("bucket_name", "results.csv")
+
+    mock_bucket.get_blob.assert_called_once_with("results.history.csv")
+    assert history["date"].iloc[0] == "15:07:2025"
+    assert history["pm25"].iloc[0] == 7
+
+
+# No history saved yet.
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_load_history_missing(mock_client):
+    mock_client.return_value.bucket.return_value.get_blob.return_value = None
+
+    assert load_history("bucket_name", "results.csv") is None
+
+
+# GCS error during loading history.
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_load_history_gcs_error(mock_client):
+    mock_client.side_effect = GoogleCloudError("Storage init error")
+
+    assert load_history("bucket_name", "results.csv") is None
+
+
+# History keeps last readings per station.
+@patch("openaq_data_pipeline.api_gcs.outlier_window", 2)
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_save_history_success(mock_client):
+    df = pd.DataFrame({"city" : ["cityA", "cityB"],
+                       "location" : ["locA", "locB"],
+                       "date" : ["15:07:2025", "15:07:2025"],
+                       "time" : ["12:00:00", "12:00:00"],
+                       "pm25" : [12.0, 20.0],
+                       "quality_flags" : ["", ""]
+                       })
+
+    history = pd.DataFrame({"city" : ["cityA", "cityA", "cityA"],
+                            "location" : ["locA", "locA", "locA"],
+                            "date" : ["15:07:2025", "15:07:2025", "15:07:2025"],
+                            "time" : ["09:00:00", "10:00:00", "12:00:00"],
+                            "pm25" : [9.0, 10.0, 11.0]
+                            })
+
+    mock_blob = MagicMock()
+    mock_bucket = MagicMock()
+    mock_bucket.blob.return_value = mock_blob
+    mock_client.return_value.bucket.return_value = mock_bucket
+
+    result = save_history(df, history, "bucket_name", "results.csv")
+
+    assert result == "gs://bucket_name/results.history.csv"
+    mock_bucket.blob.assert_called_once_with("results.history.csv")
+
+    saved = pd.read_csv(io.StringIO(mock_blob.upload_from_string.call_args[0][0]))
+    assert saved.columns.tolist() == ["city", "location", "date", "time", "pm25"]
+    assert saved["time"].tolist() == ["10:00:00", "12:00:00", "12:00:00"]
+    assert saved["pm25"].tolist() == [10.0, 12.0, 20.0]
+
+
+
+# Outliers are not saved to history - repeated spikes are flagged every time.
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_save_history_outliers(mock_client):
+    history = pd.DataFrame({"city" : ["cityA"] * 7,
+                            "location" : ["locA"] * 7,
+                            "date" : ["15:07:2025"] * 7,
+                            "time" : ["05:00:00", "06:00:00", "07:00:00", "08:00:00", "09:00:00", "10:00:00", "11:00:00"],
+                            "pm25" : [10.0, 11.0, 9.0, 12.0, 10.0, 11.0, 10.0]
+                            })
+
+    mock_blob = MagicMock()
+    mock_client.return_value.bucket.return_value.blob.return_value = mock_blob
+
+    # First spike.
+    first = pd.DataFrame({"city" : ["cityA"], "location" : ["locA"], "date" : ["15:07:2025"], "time" : ["12:00:00"],
+                          "pm25" : [300.0]})
+    first = validate_data(first, history, now = validation_now)
+    assert first["quality_flags"].iloc[0] == "pm25:outlier"
+
+    save_history(first, history, "bucket_name", "results.csv")
+    history = pd.read_csv(io.StringIO(mock_blob.upload_from_string.call_args[0][0]), dtype = {"date" : str, "time" : str})
+    assert pd.isna(history["pm25"].iloc[-1])
+
+    # Second spike in a row.
+    second = pd.DataFrame({"city" : ["cityA"], "location" : ["locA"], "date" : ["15:07:2025"], "time" : ["13:00:00"],
+                           "pm25" : [290.0]})
+    second = validate_data(second, history, now = validation_now)
+    assert second["quality_flags"].iloc[0] == "pm25:outlier"
+
+
+# GCS error during saving history.
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_save_history_gcs_error(mock_client):
+    df = pd.DataFrame({"city" : ["cityA"], "location" : ["locA"], "date" : ["15:07:2025"], "time" : ["12:00:00"]})
+
+    mock_client.side_effect = GoogleCloudError("Storage init error")
+
+    assert save_history(df, None, "bucket_name", "results.csv") is None
+
+
+
 # === Testing save_to_file ===
 
 # Successful save.
@@ -260,7 +628,7 @@ def test_save_to_file_success(mock_storage_client):
     mock_storage_client.assert_called_once()
     mock_bucket.blob.assert_called_once_with("test.csv")
     mock_blob.upload_from_string.assert_called_once()
-    assert result == "gs://bucket_name/test.csv"
+    assert result == ("gs://bucket_name/test.csv", True)
 
 
 # IOError - conversion error.
@@ -351,7 +719,7 @@ def test_save_to_file_empty_df(mock_client):
 
     result = save_to_file(df, "bucket_name", "test.csv")
 
-    assert result == "gs://bucket_name/test.csv"
+    assert result == ("gs://bucket_name/test.csv", True)
     mock_blob.upload_from_string.assert_called_once()
 
 
@@ -368,6 +736,7 @@ def test_save_to_file_args(mock_client):
     mock_blob = MagicMock()
     mock_bucket = MagicMock()
     mock_bucket.blob.return_value = mock_blob
+    mock_bucket.get_blob.return_value.generation = 42
 
     mock_storage = MagicMock()
     mock_storage.bucket.return_value = mock_bucket
@@ -377,9 +746,70 @@ def test_save_to_file_args(mock_client):
 
     mock_blob.upload_from_string.assert_called_once_with(
         expected_csv,
-        content_type = "text/csv"
+        content_type = "text/csv",
+        if_generation_match = 42
     )
-    assert result == "gs://bucket_name/test.csv"
+    assert result == ("gs://bucket_name/test.csv", True)
+
+
+# Unchanged file - upload skipped.
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_save_to_file_unchanged(mock_client):
+    df = pd.DataFrame({"city" : ["cityA"], "pm25" : [7]})
+
+    expected_md5 = base64.b64encode(hashlib.md5(df.to_csv(index = False).encode("utf-8")).digest()).decode("ascii")
+
+    mock_bucket = MagicMock()
+    mock_bucket.get_blob.return_value.md5_hash = expected_md5
+
+    mock_storage = MagicMock()
+    mock_storage.bucket.return_value = mock_bucket
+    mock_client.return_value = mock_storage
+
+    result = save_to_file(df, "bucket_name", "test.csv")
+
+    assert result == ("gs://bucket_name/test.csv", False)
+    mock_bucket.get_blob.assert_called_once_with("test.csv")
+    mock_bucket.blob.return_value.upload_from_string.assert_not_called()
+
+
+# No existing file - upload only if the object does not exist yet.
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_save_to_file_new_object(mock_client):
+    df = pd.DataFrame({"city" : ["cityA"]})
+
+    mock_blob = MagicMock()
+    mock_bucket = MagicMock()
+    mock_bucket.blob.return_value = mock_blob
+    mock_bucket.get_blob.return_value = None
+
+    mock_storage = MagicMock()
+    mock_storage.bucket.return_value = mock_bucket
+    mock_client.return_value = mock_storage
+
+    result = save_to_file(df, "bucket_name", "test.csv")
+
+    assert result == ("gs://bucket_name/test.csv", True)
+    mock_blob.upload_from_string.assert_called_once_with(ANY, content_type = "text/csv", if_generation_match = 0)
+
+
+# File changed by another writer during the upload.
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_save_to_file_precondition_failed(mock_client):
+    df = pd.DataFrame({"city" : ["cityA"]})
+
+    mock_blob = MagicMock()
+    mock_blob.upload_from_string.side_effect = PreconditionFailed("Generation mismatch")
+
+    mock_bucket = MagicMock()
+    mock_bucket.blob.return_value = mock_blob
+
+    mock_storage = MagicMock()
+    mock_storage.bucket.return_value = mock_bucket
+    mock_client.return_value = mock_storage
+
+    result = save_to_file(df, "bucket_name", "test.csv")
+    assert result is None
 
 
 
@@ -387,13 +817,15 @@ def test_save_to_file_args(mock_client):
 
 # Successful action of the function.
 @patch.dict(os.environ, {"OPENAQ_API_KEY" : "test_key", "GCS_BUCKET_NAME" : "test_bucket"}, clear = True)
+@patch("openaq_data_pipeline.api_gcs.save_history")
+@patch("openaq_data_pipeline.api_gcs.load_history", return_value = None)
 @patch("openaq_data_pipeline.api_gcs.fetch_data")
 @patch("openaq_data_pipeline.api_gcs.normalize_data")
 @patch("openaq_data_pipeline.api_gcs.save_to_file")
 @patch("openaq_data_pipeline.api_gcs.locations", {"https://openaqurl" : ["cityA", "locA"]})
 @patch("openaq_data_pipeline.api_gcs.api_key", "test_key")
 @patch("openaq_data_pipeline.api_gcs.header", {"X-API-Key": "test_key"})
-def test_run_success(mock_save, mock_normalize, mock_fetch):
+def test_run_success(mock_save, mock_normalize, mock_fetch, mock_load_history, mock_save_history):
     mock_fetch.return_value = {"results" :
                                    [{"parameter.name" : "pm25",
                                              "latest.value" : 7,
@@ -408,7 +840,7 @@ def test_run_success(mock_save, mock_normalize, mock_fetch):
                                                 })
     mock_normalize.return_value = expected_df_from_normalize
 
-    mock_save.return_value = "gs://test_bucket/test.csv"
+    mock_save.return_value = ("gs://test_bucket/test.csv", True)
 
     response = api_gcs.run(None)
 
@@ -430,7 +862,38 @@ def test_run_success(mock_save, mock_normalize, mock_fetch):
 
     actual_df_passed_to_save = mock_save.call_args[0][0]
 
-    pd.testing.assert_frame_equal(actual_df_passed_to_save, expected_df_from_normalize)
+    # Validated data - reading from 2025 is flagged as stale.
+    pd.testing.assert_frame_equal(actual_df_passed_to_save, expected_df_from_normalize.assign(quality_flags = "stale"))
+
+    mock_load_history.assert_called_once_with("test_bucket", "results.csv")
+    mock_save_history.assert_called_once_with(actual_df_passed_to_save, None, "test_bucket", "results.csv")
+
+
+
+# Unchanged file - upload skipped.
+@patch.dict(os.environ, {"OPENAQ_API_KEY" : "test_key", "GCS_BUCKET_NAME" : "test_bucket"}, clear = True)
+@patch("openaq_data_pipeline.api_gcs.save_history")
+@patch("openaq_data_pipeline.api_gcs.load_history", return_value = None)
+@patch("openaq_data_pipeline.api_gcs.fetch_data")
+@patch("openaq_data_pipeline.api_gcs.normalize_data")
+@patch("openaq_data_pipeline.api_gcs.save_to_file")
+@patch("openaq_data_pipeline.api_gcs.locations", {"https://openaqurl" : ["cityA", "locA"]})
+@patch("openaq_data_pipeline.api_gcs.api_key", "test_key")
+@patch("openaq_data_pipeline.api_gcs.header", {"X-API-Key": "test_key"})
+def test_run_upload_skipped(mock_save, mock_normalize, mock_fetch, mock_load_history, mock_save_history):
+    mock_fetch.return_value = {"results" : []}
+    mock_normalize.return_value = pd.DataFrame({"city" : ["cityA"],
+                                                "location" : ["locA"],
+                                                "date" : ["15:07:2025"],
+                                                "time" : ["12:12:12"],
+                                                "pm25" : [7]
+                                                })
+    mock_save.return_value = ("gs://test_bucket/results.csv", False)
+
+    response = api_gcs.run(None)
+
+    assert response == "File unchanged - upload to gs://test_bucket/results.csv skipped"
+    mock_save_history.assert_not_called()
 
 
 # No API key.
@@ -488,4 +951,131 @@ def test_run_no_bucket_name(mock_fetch, mock_normalize):
         {"results": [{"parameter.name": "pm25", "latest.value": 11, "latest.datetime.utc": "2025-07-15T12:12:12Z"}]},
         "cityA",
         "locA"
-    )
\ No newline at end of file
+    )
+
+
+
+# === Testing profiling ===
+
+# Profiling disabled by default.
+@patch.dict(os.environ, {}, clear = True)
+def test_profiling_enabled_default():
+    assert profiling_enabled(None) is False
+
+
+# Profiling sampled for every run.
+@patch.dict(os.environ, {"PROFILE_SAMPLE_RATE" : "1"}, clear = True)
+def test_profiling_enabled_sample_rate():
+    assert profiling_enabled(None) is True
+
+
+# Incorrect sample rate.
+@patch.dict(os.environ, {"PROFILE_SAMPLE_RATE" : "often"}, clear = True)
+def test_profiling_enabled_incorrect_sample_rate():
+    assert profiling_enabled(None) is False
+
+
+# Request parameter takes precedence over sampling.
+@patch.dict(os.environ, {"PROFILE_SAMPLE_RATE" : "1"}, clear = True)
+def test_profiling_enabled_request_param():
+    mock_request = MagicMock()
+    mock_request.args = {"profile" : "0"}
+    assert profiling_enabled(mock_request) is False
+
+    mock_request.args = {"profile" : "true"}
+    assert profiling_enabled(mock_request) is True
+
+
+# No profiling - function is called directly.
+def test_profile_call_disabled():
+    mock_func = MagicMock(return_value = "data")
+
+    assert profile_call(None, "fetch_data", mock_func, "url") == "data"
+    mock_func.assert_called_once_with("url")
+
+
+# Profiling collects stats over all calls.
+def test_profile_call_enabled():
+    profile = {}
+
+    tracemalloc.start()
+    try:
+        profile_call(profile, "build", lambda n: [str(i) for i in range(n)], 1000)
+        result = profile_call(profile, "build", lambda n: [str(i) for i in range(n)], 10)
+
+    finally:
+        tracemalloc.stop()
+
+    assert len(result) == 10
+    assert profile["build"]["peak"] > 0
+    assert profile["build"]["allocations"]
+
+
+# Profiling report saved to local directory.
+def test_save_profile_local(tmp_path):
+    profile = {}
+
+    tracemalloc.start()
+    try:
+        profile_call(profile, "normalize_data", lambda: [0] * 1000)
+
+    finally:
+        tracemalloc.stop()
+
+    with patch.dict(os.environ, {"PROFILE_OUTPUT_DIR" : str(tmp_path)}, clear = True):
+        report_path = save_profile(profile, "bucket_name", "results.csv")
+
+    report_name = os.path.basename(report_path)
+    assert re.fullmatch(r"results\.\d{8}T\d{6}\.profile\.txt", report_name)
+    assert os.path.dirname(report_path) == str(tmp_path)
+    report = (tmp_path / report_name).read_text()
+    assert "=== normalize_data ===" in report
+    assert "Top allocation sites:" in report
+    assert "Cumulative-time stats:" in report
+
+
+# Profiling report saved to GCS bucket.
+@patch.dict(os.environ, {}, clear = True)
+@patch("openaq_data_pipeline.api_gcs.storage.Client")
+def test_save_profile_gcs(mock_client):
+    mock_blob = MagicMock()
+    mock_bucket = MagicMock()
+    mock_bucket.blob.return_value = mock_blob
+    mock_client.return_value.bucket.return_value = mock_bucket
+
+    report_path = save_profile({}, "bucket_name", "results.csv")
+
+    assert re.fullmatch(r"gs://bucket_name/results\.\d{8}T\d{6}\.profile\.txt", report_path)
+    mock_bucket.blob.assert_called_once_with(report_path.removeprefix("gs://bucket_name/"))
+    mock_blob.upload_from_string.assert_called_once_with(ANY, content_type = "text/plain")
+
+
+# Profiled run saves the report next to the output.
+@patch.dict(os.environ, {"OPENAQ_API_KEY" : "test_key", "GCS_BUCKET_NAME" : "test_bucket", "PROFILE_SAMPLE_RATE" : "1"}, clear = True)
+@patch("openaq_data_pipeline.api_gcs.save_profile")
+@patch("openaq_data_pipeline.api_gcs.save_history")
+@patch("openaq_data_pipeline.api_gcs.load_history", return_value = None)
+@patch("openaq_data_pipeline.api_gcs.fetch_data")
+@patch("openaq_data_pipeline.api_gcs.normalize_data")
+@patch("openaq_data_pipeline.api_gcs.save_to_file")
+@patch("openaq_data_pipeline.api_gcs.locations", {"https://openaqurl" : ["cityA", "locA"]})
+@patch("openaq_data_pipeline.api_gcs.api_key", "test_key")
+@patch("openaq_data_pipeline.api_gcs.header", {"X-API-Key": "test_key"})
+def test_run_profiled(mock_save, mock_normalize, mock_fetch, mock_load_history, mock_save_history, mock_save_profile):
+    mock_fetch.return_value = {"results" : []}
+    mock_normalize.return_value = pd.DataFrame({"city" : ["cityA"],
+                                                "location" : ["locA"],
+                                                "date" : ["15:07:2025"],
+                                                "time" : ["12:12:12"],
+                                                "pm25" : [7]
+                                                })
+    mock_save.return_value = ("gs://test_bucket/results.csv", True)
+
+    response = api_gcs.run(None)
+
+    assert response == "File uploaded to gs://test_bucket/results.csv"
+    assert not tracemalloc.is_tracing()
+
+    mock_save_profile.assert_called_once_with(ANY, "test_bucket", "results.csv")
+    profile = mock_save_profile.call_args[0][0]
+    assert set(profile) == {"fetch_data", "normalize_data", "validate_data", "save_to_file"}